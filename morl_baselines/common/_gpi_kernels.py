@@ -0,0 +1,32 @@
+"""Numba kernels for Generalized Policy Improvement (GPI) with tabular Q-values."""
+from typing import Tuple
+
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True, fastmath=True, boundscheck=False)
+def gpi_argmax(q_rows: np.ndarray, w: np.ndarray) -> Tuple[int, int]:
+    """Returns the policy and action maximizing the linearly scalarized Q-values.
+
+    GPI(s, w) = argmax_a max_pi Q^pi(s, a) . w
+
+    Args:
+        q_rows: Q-values of all policies for one state, of shape (num_policies, action_dim, reward_dim)
+        w: Weight vector
+
+    Returns:
+        (int, int): Index of the best policy and best action. Ties are broken by the first index, as in np.argmax.
+    """
+    # fastmath assumes no infinities, so the running best starts at the first score instead of -inf
+    best = 0.0
+    best_p, best_a = 0, 0
+    for p in range(q_rows.shape[0]):
+        for a in range(q_rows.shape[1]):
+            s = 0.0
+            for r in range(q_rows.shape[2]):
+                s += q_rows[p, a, r] * w[r]
+            if (p == 0 and a == 0) or s > best:
+                best = s
+                best_p, best_a = p, a
+    return best_p, best_a
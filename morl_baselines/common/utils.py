@@ -264,7 +264,8 @@ def log_all_multi_policy_metrics(
         columns=[f"objective_{i}" for i in range(1, reward_dim + 1)],
         data=[p.tolist() for p in current_front],
     )
-    wandb.log({"eval/front": front}, step=global_step)
+    # Logged against the global_step metric declared in setup_wandb, so that fronts may arrive after later steps
+    wandb.log({"eval/front": front, "global_step": global_step})
 
     # If PF is known, log the additional metrics
     if ref_front is not None:
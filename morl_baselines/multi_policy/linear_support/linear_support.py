@@ -45,7 +45,9 @@ class LinearSupport:
         self.num_objectives = num_objectives
         self.epsilon = epsilon
         self.visited_weights = []  # List of already tested weight vectors
-        self.ccs = []
+        # Value vectors of the CCS, stored as the first _n rows of a preallocated matrix (capacity doubles when full)
+        self._ccs = np.empty((8, self.num_objectives))
+        self._n = 0
         self.weight_support = []  # List of weight vectors for each value vector in the CCS
         self.queue = []
         self.iteration = 0
@@ -53,6 +55,24 @@ class LinearSupport:
         for w in extrema_weights(self.num_objectives):
             self.queue.append((float("inf"), w))
 
+    @property
+    def ccs(self) -> np.ndarray:
+        """Value vectors of the Convex Coverage Set (CCS), one per row.
+
+        The returned array is a read-only view of the CCS at the time of the call. It is not updated by later calls to
+        add_solution, so the property must be read again after each update.
+        """
+        ccs = self._ccs[: self._n]
+        ccs.flags.writeable = False
+        return ccs
+
+    def _append_ccs(self, value: np.ndarray):
+        """Appends a value vector to the CCS, growing the underlying matrix if needed. Only rows after the current CCS are written."""
+        if self._n == self._ccs.shape[0]:
+            self._ccs = np.concatenate((self._ccs, np.empty_like(self._ccs)), axis=0)
+        self._ccs[self._n] = value
+        self._n += 1
+
     def next_weight(
         self, algo: str = "ols", gpi_agent: Optional[MOPolicy] = None, env: Optional[Env] = None, rep_eval: int = 1
     ) -> np.ndarray:
@@ -72,15 +92,18 @@ class LinearSupport:
             if self.verbose:
                 print("W_corner:", W_corner, "W_corner size:", len(W_corner))
 
+            if algo == "gpi-ls":
+                if gpi_agent is None:
+                    raise ValueError("GPI-LS requires passing a GPI agent.")
+                # The GPI policy is evaluated once per corner weight, and the results are shared by all priorities
+                gpi_expanded_set = [policy_evaluation_mo(gpi_agent, env, wc, rep=rep_eval)[3] for wc in W_corner]
+
             self.queue = []
             for wc in W_corner:
                 if algo == "ols":
                     priority = self.ols_priority(wc)
 
                 elif algo == "gpi-ls":
-                    if gpi_agent is None:
-                        raise ValueError("GPI-LS requires passing a GPI agent.")
-                    gpi_expanded_set = [policy_evaluation_mo(gpi_agent, env, wc, rep=rep_eval)[3] for wc in W_corner]
                     priority = self.gpi_ls_priority(wc, gpi_expanded_set)
 
                 if self.epsilon is None or priority >= self.epsilon:
@@ -159,7 +182,7 @@ class LinearSupport:
 
         removed_indx = self.remove_obsolete_values(value)
 
-        self.ccs.append(value)
+        self._append_ccs(value)
         self.weight_support.append(w)
 
         return removed_indx
@@ -213,7 +236,7 @@ class LinearSupport:
         """
         if len(self.ccs) == 0:
             return None
-        return np.max([np.dot(v, w) for v in self.ccs])
+        return np.max(self.ccs @ w)
 
     def remove_obsolete_weights(self, new_value: np.ndarray) -> List[np.ndarray]:
         """Remove from the queue the weight vectors for which the new value vector is better than previous values.
@@ -245,19 +268,22 @@ class LinearSupport:
         Returns:
              the indices of the removed values.
         """
-        removed_indx = []
-        for i in reversed(range(len(self.ccs))):
-            best_in_all = True
-            for j in range(len(self.visited_weights)):
-                w = self.visited_weights[j]
-                if np.dot(value, w) < np.dot(self.ccs[i], w):
-                    best_in_all = False
-                    break
-
-            if best_in_all:
-                removed_indx.append(i)
-                self.ccs.pop(i)
-                self.weight_support.pop(i)
+        # Scalarized values for all visited weights; the last row is the new value
+        scores = np.vstack((self.ccs, value)) @ self._visited_weights_matrix().T
+        # A value vector is obsolete if the new value is at least as good for all visited weights
+        best_in_all = np.all(scores[-1] >= scores[:-1], axis=1)
+        removed_indx = [int(i) for i in reversed(np.flatnonzero(best_in_all))]
+        for i in removed_indx:
+            self.weight_support.pop(i)
+
+        if len(removed_indx) > 0:
+            # The kept values are moved to a new matrix, so that the views returned earlier by ccs are left unchanged
+            keep = ~best_in_all
+            n_kept = int(keep.sum())
+            ccs = np.empty_like(self._ccs)
+            ccs[:n_kept] = self.ccs[keep]
+            self._ccs = ccs
+            self._n = n_kept
 
         return removed_indx
 
@@ -356,10 +382,14 @@ class LinearSupport:
         """
         if len(self.ccs) == 0:
             return False
-        for w in self.visited_weights:
-            if np.dot(value, w) >= self.max_scalarized_value(w):
-                return False
-        return True
+        # Scalarized values for all visited weights; the last row is the new value
+        scores = np.vstack((self.ccs, value)) @ self._visited_weights_matrix().T
+        # Dominated if, for every visited weight, some value in the CCS is strictly better
+        return bool(np.all(scores[-1] < scores[:-1].max(axis=0)))
+
+    def _visited_weights_matrix(self) -> np.ndarray:
+        """Returns the visited weight vectors stacked as rows."""
+        return np.array(self.visited_weights).reshape(-1, self.num_objectives)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,10 @@
 """Outer-loop MOQ-learning algorithm (uses multiple weights)."""
+import multiprocessing
+import queue
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
 from typing import List, Optional
 from typing_extensions import override
@@ -7,6 +12,7 @@ from typing_extensions import override
 import gymnasium as gym
 import numpy as np
 
+from morl_baselines.common._gpi_kernels import gpi_argmax
 from morl_baselines.common.evaluation import policy_evaluation_mo
 from morl_baselines.common.morl_algorithm import MOAgent
 from morl_baselines.common.scalarization import weighted_sum
@@ -19,6 +25,46 @@ from morl_baselines.multi_policy.linear_support.linear_support import LinearSupp
 from morl_baselines.single_policy.ser.mo_q_learning import MOQLearning
 
 
+def _stack_q_rows(q_tables: List[dict], obs: np.ndarray, action_dim: int, reward_dim: int) -> np.ndarray:
+    """Returns the Q-values of obs in each Q-table, stacked in a (num_policies, action_dim, reward_dim) array. Unseen observations have zero Q-values."""
+    t_obs = tuple(obs)
+    zeros = np.zeros((action_dim, reward_dim))
+    return np.stack([q_table.get(t_obs, zeros) for q_table in q_tables])
+
+
+class _GPIEvaluator:
+    """Picklable snapshot of the GPI policy of MPMOQLearning (with linear scalarization), used by evaluation workers."""
+
+    def __init__(self, q_tables: List[dict], action_dim: int, reward_dim: int, gamma: float):
+        """Initialize the snapshot from the Q-tables of the policies."""
+        self.q_tables = q_tables
+        self.action_dim = action_dim
+        self.reward_dim = reward_dim
+        self.gamma = gamma
+
+    def eval(self, obs: np.ndarray, w: np.ndarray) -> int:
+        """Returns the GPI action for the given observation and weights."""
+        q_rows = _stack_q_rows(self.q_tables, obs, self.action_dim, self.reward_dim)
+        _, action = gpi_argmax(q_rows, np.asarray(w, dtype=np.float64))
+        return int(action)
+
+
+# Evaluation environment of the current worker process, set once when the worker starts
+_worker_env = None
+
+
+def _init_evaluation_worker(env: gym.Env):
+    """Keeps a copy of the evaluation environment in the worker process, reused by all its evaluations."""
+    global _worker_env
+    _worker_env = env
+
+
+def _gpi_evaluation_worker(args) -> List[np.ndarray]:
+    """Evaluates a GPI snapshot for a chunk of weight vectors. Returns the average discounted vector return for each weight vector."""
+    evaluator, weights, rep = args
+    return [policy_evaluation_mo(agent=evaluator, env=_worker_env, w=w, rep=rep)[3] for w in weights]
+
+
 class MPMOQLearning(MOAgent):
     """Multi-policy MOQ-Learning: Outer loop version of mo_q_learning.
 
@@ -40,6 +86,8 @@ class MPMOQLearning(MOAgent):
         transfer_q_table: bool = True,
         dyna: bool = False,
         dyna_updates: int = 5,
+        num_eval_workers: int = 1,
+        use_numba: bool = False,
         project_name: str = "MORL-Baselines",
         experiment_name: str = "MultiPolicy MO Q-Learning",
         log: bool = True,
@@ -60,6 +108,8 @@ class MPMOQLearning(MOAgent):
             transfer_q_table: Whether to reuse a Q-table from a previous learned policy when initializing a new policy.
             dyna: Whether to use Dyna-Q or not.
             dyna_updates: The number of Dyna-Q updates to perform.
+            num_eval_workers: The number of processes used to evaluate the GPI policy on the weights of the front. Only used with the weighted sum scalarization, otherwise evaluations are sequential. Starting the workers takes seconds, so the pool only pays off when evaluating the front is expensive (slow environments, long episodes, many weights); for small environments such as Deep Sea Treasure, keep the default of 1. The workers are spawned, so scripts must guard their entry point with if __name__ == "__main__".
+            use_numba: Whether the policies perform their Q-updates with a numba-compiled kernel. Requires the weighted sum scalarization.
             project_name: The name of the project for logging.
             experiment_name: The name of the experiment for logging.
             log: Whether to log or not.
@@ -76,6 +126,14 @@ class MPMOQLearning(MOAgent):
         self.dyna = dyna
         self.dyna_updates = dyna_updates
         self.transfer_q_table = transfer_q_table
+        self.num_eval_workers = num_eval_workers
+        self.use_numba = use_numba
+        assert not self.use_numba or self.scalarization is weighted_sum, "use_numba requires the weighted_sum scalarization."
+        self._eval_pool = None
+        self._eval_pool_env = None
+        # LRU cache of the stacked Q-values (num_policies, action_dim, reward_dim) of the policies for recently visited states
+        self._q_rows_cache = OrderedDict()
+        self._q_rows_cache_size = 1024
         # Linear support
         self.policies = []
         self.weight_selection_algo = weight_selection_algo
@@ -86,6 +144,9 @@ class MPMOQLearning(MOAgent):
             "gpi-ls",
         ], f"Unknown weight selection algorithm: {self.weight_selection_algo}."
         self.linear_support = LinearSupport(num_objectives=self.reward_dim, epsilon=epsilon_ols)
+        if self.scalarization is weighted_sum:
+            # Compile the GPI kernel once, instead of during the first evaluation
+            gpi_argmax(np.zeros((1, 1, self.reward_dim)), np.zeros(self.reward_dim))
 
         # Logging
         self.project_name = project_name
@@ -94,6 +155,11 @@ class MPMOQLearning(MOAgent):
 
         if self.log:
             self.setup_wandb(project_name=self.project_name, experiment_name=self.experiment_name)
+            # Multi-policy metrics are computed and sent to wandb in the background, so they do not block training.
+            # The logging thread is started by train.
+            self._log_queue = queue.Queue()
+            self._log_error = None
+            self._log_thread = None
         else:
             self.writer = None
 
@@ -113,8 +179,55 @@ class MPMOQLearning(MOAgent):
             "transfer_q_table": self.transfer_q_table,
             "dyna": self.dyna,
             "dyna_updates": self.dyna_updates,
+            "num_eval_workers": self.num_eval_workers,
+            "use_numba": self.use_numba,
         }
 
+    @property
+    def policies(self) -> List[MOQLearning]:
+        """The learned policies. Assign a new list to change them, so that the cached Q-values are invalidated."""
+        return self._policies
+
+    @policies.setter
+    def policies(self, policies: List[MOQLearning]):
+        self._policies = policies
+        self._q_rows_cache.clear()
+
+    def _log_worker(self):
+        """Logs the multi-policy metrics put in the logging queue, until it receives None.
+
+        An error raised while logging is stored, and re-raised in the training thread by _raise_log_error.
+        """
+        while True:
+            metrics = self._log_queue.get()
+            if metrics is None:
+                break
+            if self._log_error is None:
+                try:
+                    log_all_multi_policy_metrics(**metrics)
+                except Exception as e:
+                    self._log_error = e
+
+    def _raise_log_error(self):
+        """Re-raises the error of the logging thread, if any."""
+        if self._log_error is not None:
+            error, self._log_error = self._log_error, None
+            raise error
+
+    def _start_log_thread(self):
+        """Starts the logging thread, unless it is already running (it stops when wandb is closed at the end of train)."""
+        if self._log_thread is None or not self._log_thread.is_alive():
+            self._log_thread = threading.Thread(target=self._log_worker, daemon=True)
+            self._log_thread.start()
+
+    @override
+    def close_wandb(self) -> None:
+        if self._log_thread is not None and self._log_thread.is_alive():
+            self._log_queue.put(None)
+            self._log_thread.join()
+        super().close_wandb()
+        self._raise_log_error()
+
     def _gpi_action(self, state: np.ndarray, w: np.ndarray) -> int:
         """Get the action given by the GPI policy.
 
@@ -127,22 +240,88 @@ class MPMOQLearning(MOAgent):
         Returns:
             The action to take.
         """
-        q_vals = np.stack([policy.scalarized_q_values(state, w) for policy in self.policies])
-        _, action = np.unravel_index(np.argmax(q_vals), q_vals.shape)
+        if self.scalarization is not weighted_sum:
+            q_vals = np.stack([policy.scalarized_q_values(state, w) for policy in self.policies])
+            _, action = np.unravel_index(np.argmax(q_vals), q_vals.shape)
+            return int(action)
+
+        # Linear scalarization: a single fused loop over all policies and actions
+        _, action = gpi_argmax(self._q_rows(state), np.asarray(w, dtype=np.float64))
         return int(action)
 
+    def _q_rows(self, state: np.ndarray) -> np.ndarray:
+        """Returns the Q-values of all policies for the given state, stacked in a (num_policies, action_dim, reward_dim) array."""
+        key = np.asarray(state).tobytes()
+        q_rows = self._q_rows_cache.get(key)
+        if q_rows is not None:
+            self._q_rows_cache.move_to_end(key)
+            return q_rows
+
+        q_rows = _stack_q_rows([policy.q_table for policy in self.policies], state, self.action_dim, self.reward_dim)
+        self._q_rows_cache[key] = q_rows
+        if len(self._q_rows_cache) > self._q_rows_cache_size:
+            self._q_rows_cache.popitem(last=False)
+        return q_rows
+
     def eval(self, obs: np.array, w: Optional[np.ndarray] = None) -> int:
         """If use_gpi is True, return the action given by the GPI policy. Otherwise, chooses the best policy for w and follows it."""
         if self.use_gpi_policy:
             return self._gpi_action(obs, w)
         else:
-            best_policy = np.argmax([np.dot(w, v) for v in self.linear_support.ccs])
+            best_policy = np.argmax(self.linear_support.ccs @ w)
             return self.policies[best_policy].eval(obs, w)
 
     def delete_policies(self, delete_indx: List[int]):
         """Delete the policies with the given indices."""
-        for i in sorted(delete_indx, reverse=True):
-            self.policies.pop(i)
+        if len(delete_indx) == 0:
+            return
+        keep = np.ones(len(self.policies), dtype=bool)
+        keep[delete_indx] = False
+        self.policies = [policy for policy, k in zip(self.policies, keep) if k]
+
+    def _evaluate_gpi_front(self, env: gym.Env, weights: np.ndarray, rep: int) -> np.ndarray:
+        """Evaluates the GPI policy for each weight vector, using a pool of worker processes if num_eval_workers > 1.
+
+        Args:
+            env: The environment to use for evaluation.
+            weights: The weight vectors to evaluate the GPI policy on, of shape (n_weights, reward_dim).
+            rep: The number of episodes used to evaluate each weight vector.
+
+        Returns:
+            The average discounted vector return for each weight vector, of shape (len(weights), reward_dim).
+        """
+        front = np.empty((len(weights), self.reward_dim))
+        if self.num_eval_workers <= 1 or self.scalarization is not weighted_sum:
+            for i, w in enumerate(weights):
+                front[i] = policy_evaluation_mo(agent=self, env=env, w=w, rep=rep)[3]
+            return front
+
+        if self._eval_pool is not None and self._eval_pool_env is not env:
+            self._close_eval_pool()
+        if self._eval_pool is None:
+            # Each worker receives its own copy of env once, instead of once per evaluation.
+            # Workers are spawned, since forking while the logging and wandb threads run can deadlock the children.
+            self._eval_pool = ProcessPoolExecutor(
+                max_workers=self.num_eval_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_evaluation_worker,
+                initargs=(env,),
+            )
+            self._eval_pool_env = env
+        evaluator = _GPIEvaluator([policy.q_table for policy in self.policies], self.action_dim, self.reward_dim, self.gamma)
+        # One task per worker, so that the Q-tables are sent once per worker
+        chunks = np.array_split(np.arange(len(weights)), min(self.num_eval_workers, len(weights)))
+        tasks = [(evaluator, weights[chunk], rep) for chunk in chunks]
+        for chunk, values in zip(chunks, self._eval_pool.map(_gpi_evaluation_worker, tasks)):
+            front[chunk] = values
+        return front
+
+    def _close_eval_pool(self):
+        """Shuts down the pool of evaluation workers, if any."""
+        if self._eval_pool is not None:
+            self._eval_pool.shutdown()
+            self._eval_pool = None
+            self._eval_pool_env = None
 
     def train(
         self,
@@ -171,69 +350,79 @@ class MPMOQLearning(MOAgent):
         if eval_env is None:
             eval_env = deepcopy(self.env)
 
-        eval_weights = equally_spaced_weights(self.reward_dim, n=eval_weights_number_for_front)
+        # Rows of a single contiguous matrix, so that each weight vector is a view
+        eval_weights = np.ascontiguousarray(equally_spaced_weights(self.reward_dim, n=eval_weights_number_for_front))
+        if self.log:
+            self._start_log_thread()
+
+        # The pool of evaluation workers is shut down even if training fails, so that its processes do not leak
+        try:
+            for iter in range(num_iterations):
+                if self.weight_selection_algo == "ols" or self.weight_selection_algo == "gpi-ls":
+                    w = self.linear_support.next_weight(
+                        algo=self.weight_selection_algo,
+                        gpi_agent=self if self.weight_selection_algo == "gpi-ls" else None,
+                        env=eval_env if self.weight_selection_algo == "gpi-ls" else None,
+                        rep_eval=num_episodes_eval,
+                    )
+                elif self.weight_selection_algo == "random":
+                    w = random_weights(self.reward_dim)
 
-        for iter in range(num_iterations):
-            if self.weight_selection_algo == "ols" or self.weight_selection_algo == "gpi-ls":
-                w = self.linear_support.next_weight(
-                    algo=self.weight_selection_algo,
-                    gpi_agent=self if self.weight_selection_algo == "gpi-ls" else None,
-                    env=eval_env if self.weight_selection_algo == "gpi-ls" else None,
-                    rep_eval=num_episodes_eval,
+                new_agent = MOQLearning(
+                    env=self.env,
+                    id=iter,
+                    weights=w,
+                    scalarization=self.scalarization,
+                    learning_rate=self.learning_rate,
+                    gamma=self.gamma,
+                    initial_epsilon=self.initial_epsilon,
+                    final_epsilon=self.final_epsilon,
+                    epsilon_decay_steps=self.epsilon_decay_steps,
+                    dyna=self.dyna,
+                    dyna_updates=self.dyna_updates,
+                    use_numba=self.use_numba,
+                    log=self.log,
+                    parent_writer=self.writer,
                 )
-            elif self.weight_selection_algo == "random":
-                w = random_weights(self.reward_dim)
-
-            new_agent = MOQLearning(
-                env=self.env,
-                id=iter,
-                weights=w,
-                scalarization=self.scalarization,
-                learning_rate=self.learning_rate,
-                gamma=self.gamma,
-                initial_epsilon=self.initial_epsilon,
-                final_epsilon=self.final_epsilon,
-                epsilon_decay_steps=self.epsilon_decay_steps,
-                dyna=self.dyna,
-                dyna_updates=self.dyna_updates,
-                log=self.log,
-                parent_writer=self.writer,
-            )
-            if self.transfer_q_table and len(self.policies) > 0:
-                reuse_ind = np.argmax([np.dot(w, v) for v in self.linear_support.ccs])
-                new_agent.q_table = deepcopy(self.policies[reuse_ind].q_table)
-            self.policies.append(new_agent)
-
-            start_time = time.time()
-            new_agent.global_step = self.global_step
-            new_agent.train(
-                start_time=start_time,
-                total_timesteps=timesteps_per_iteration,
-                reset_num_timesteps=False,
-                eval_freq=eval_freq,
-                eval_env=eval_env,
-            )
-            self.global_step = new_agent.global_step
-
-            value = policy_evaluation_mo(agent=new_agent, env=eval_env, w=w, rep=num_episodes_eval)[3]
-            removed_inds = self.linear_support.add_solution(value, w)
-            self.delete_policies(removed_inds)
-
-            if self.log:
-                if self.use_gpi_policy:
-                    front = [
-                        policy_evaluation_mo(agent=self, env=eval_env, w=w, rep=num_episodes_eval)[3] for w in eval_weights
-                    ]
-                else:
-                    front = self.linear_support.ccs
-                log_all_multi_policy_metrics(
-                    current_front=front,
-                    hv_ref_point=ref_point,
-                    reward_dim=self.reward_dim,
-                    global_step=self.global_step,
-                    writer=self.writer,
-                    ref_front=known_pareto_front,
+                if self.transfer_q_table and len(self.policies) > 0:
+                    reuse_ind = np.argmax(self.linear_support.ccs @ w)
+                    new_agent.q_table = self.policies[reuse_ind]._clone_q_table()
+
+                start_time = time.time()
+                new_agent.global_step = self.global_step
+                new_agent.train(
+                    start_time=start_time,
+                    total_timesteps=timesteps_per_iteration,
+                    reset_num_timesteps=False,
+                    eval_freq=eval_freq,
+                    eval_env=eval_env,
                 )
+                self.global_step = new_agent.global_step
+                # Added once trained, since the Q-values of the policies must not change while they are cached
+                self.policies = self.policies + [new_agent]
+
+                value = policy_evaluation_mo(agent=new_agent, env=eval_env, w=w, rep=num_episodes_eval)[3]
+                removed_inds = self.linear_support.add_solution(value, w)
+                self.delete_policies(removed_inds)
+
+                if self.log:
+                    if self.use_gpi_policy:
+                        front = self._evaluate_gpi_front(eval_env, eval_weights, num_episodes_eval)
+                    else:
+                        front = self.linear_support.ccs
+                    self._raise_log_error()
+                    self._log_queue.put(
+                        dict(
+                            current_front=front,
+                            hv_ref_point=ref_point,
+                            reward_dim=self.reward_dim,
+                            global_step=self.global_step,
+                            writer=self.writer,
+                            ref_front=known_pareto_front,
+                        )
+                    )
+        finally:
+            self._close_eval_pool()
 
         if self.writer is not None:
             self.close_wandb()
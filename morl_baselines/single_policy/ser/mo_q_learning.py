@@ -1,10 +1,12 @@
 """Scalarized Q-learning for single policy multi-objective reinforcement learning."""
 import time
+from collections.abc import MutableMapping
 from typing import Optional
 from typing_extensions import override
 
 import gymnasium as gym
 import numpy as np
+from numba import njit
 from torch.utils.tensorboard import SummaryWriter
 
 from morl_baselines.common.model_based.tabular_model import TabularModel
@@ -13,6 +15,110 @@ from morl_baselines.common.scalarization import weighted_sum
 from morl_baselines.common.utils import linearly_decaying_value, log_episode_info
 
 
+@njit(cache=True, fastmath=True)
+def _numba_q_step(
+    q_values: np.ndarray,
+    next_q_values: np.ndarray,
+    action: int,
+    reward: np.ndarray,
+    terminated: float,
+    w: np.ndarray,
+    learning_rate: float,
+    gamma: float,
+    td_error: np.ndarray,
+) -> np.ndarray:
+    """Performs one Q-learning update in place, acting greedily w.r.t. the weighted sum scalarization.
+
+    Args:
+        q_values: Q-values of the current state, of shape (action_dim, reward_dim). Updated in place.
+        next_q_values: Q-values of the next state, of shape (action_dim, reward_dim)
+        action: Action taken
+        reward: Reward vector
+        terminated: 1.0 if the next state is terminal, 0.0 otherwise
+        w: Weight vector
+        learning_rate: The learning rate
+        gamma: The discount factor
+        td_error: Array of shape (reward_dim,) where the TD error vector is written
+
+    Returns:
+        np.ndarray: The TD error vector
+    """
+    # Greedy next action, ties broken by the first index as in np.argmax
+    best, best_a = 0.0, 0
+    for a in range(next_q_values.shape[0]):
+        s = 0.0
+        for r in range(next_q_values.shape[1]):
+            s += next_q_values[a, r] * w[r]
+        if a == 0 or s > best:
+            best, best_a = s, a
+
+    for r in range(q_values.shape[1]):
+        td_error[r] = reward[r] + (1.0 - terminated) * gamma * next_q_values[best_a, r] - q_values[action, r]
+    for r in range(q_values.shape[1]):
+        q_values[action, r] += learning_rate * td_error[r]
+    return td_error
+
+
+class COWQTable(MutableMapping):
+    """Q table mapping observations to (action_dim, reward_dim) Q-value arrays, with copy-on-write sharing.
+
+    clone() shares the Q-value arrays instead of copying them. Shared arrays are read-only, and a table copies an array
+    only the first time it writes to it through writable().
+    """
+
+    def __init__(self):
+        """Initializes an empty Q table."""
+        self._data = dict()
+        self._owned = set()  # Observations whose Q-value array is not shared with another table
+
+    def __getitem__(self, obs) -> np.ndarray:
+        """Returns the Q-values of obs, read-only if they are shared. Use writable() to update them in place."""
+        return self._data[obs]
+
+    def __setitem__(self, obs, q_values: np.ndarray):
+        """Sets the Q-values of obs."""
+        self._data[obs] = q_values
+        self._owned.add(obs)
+
+    def __delitem__(self, obs):
+        """Deletes the Q-values of obs."""
+        del self._data[obs]
+        self._owned.discard(obs)
+
+    def __iter__(self):
+        """Iterates over the observations in the table."""
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        """Returns the number of observations in the table."""
+        return len(self._data)
+
+    def __contains__(self, obs) -> bool:
+        """Returns whether obs is in the table."""
+        return obs in self._data
+
+    def get(self, obs, default=None):
+        """Returns the Q-values of obs, or default if obs is not in the table."""
+        return self._data.get(obs, default)
+
+    def writable(self, obs) -> np.ndarray:
+        """Returns the Q-values of obs for in-place updates, copying them into a writable array first if they are shared."""
+        if obs not in self._owned:
+            self._data[obs] = self._data[obs].copy()
+            self._owned.add(obs)
+        return self._data[obs]
+
+    def clone(self) -> "COWQTable":
+        """Returns a copy of the table that shares the Q-value arrays until either table writes to them."""
+        clone = COWQTable()
+        clone._data = dict(self._data)
+        # The arrays are now shared, so in-place writes must fail and both tables must copy them before writing
+        for q_values in self._data.values():
+            q_values.flags.writeable = False
+        self._owned.clear()
+        return clone
+
+
 class MOQLearning(MOPolicy, MOAgent):
     """Scalarized Q learning for single policy multi-objective reinforcement learning.
 
@@ -34,6 +140,7 @@ class MOQLearning(MOPolicy, MOAgent):
         learning_starts: int = 0,
         dyna: bool = False,
         dyna_updates: int = 5,
+        use_numba: bool = False,
         project_name: str = "MORL-baselines",
         experiment_name: str = "MO Q-Learning",
         log: bool = True,
@@ -54,6 +161,7 @@ class MOQLearning(MOPolicy, MOAgent):
             learning_starts: The number of steps to wait before starting to learn
             dyna: Whether to use Dyna-Q or not
             dyna_updates: The number of Dyna-Q updates to perform each step
+            use_numba: Whether to perform the Q-updates with a numba-compiled kernel. Requires the weighted sum scalarization.
             project_name: The name of the project used for logging
             experiment_name: The name of the experiment used for logging
             log: Whether to log or not
@@ -78,8 +186,15 @@ class MOQLearning(MOPolicy, MOAgent):
 
         self.weights = weights
         self.scalarization = scalarization
+        self._linear_scalarization = scalarization is weighted_sum
+        self.use_numba = use_numba
+        assert not self.use_numba or self._linear_scalarization, "use_numba requires the weighted_sum scalarization."
+        if self.use_numba:
+            # Reused by every numba update. Dyna updates write their own TD error, so the logged one is from the real transition
+            self._td_error = np.empty(self.reward_dim)
+            self._dyna_td_error = np.empty(self.reward_dim)
 
-        self.q_table = dict()
+        self.q_table = COWQTable()
 
         if self.dyna:
             self.model = TabularModel()
@@ -90,6 +205,17 @@ class MOQLearning(MOPolicy, MOAgent):
         if self.log and parent_writer is None:
             self.setup_wandb(project_name, experiment_name)
 
+    @property
+    def weights(self) -> np.ndarray:
+        """The weights of the scalarization function."""
+        return self._weights
+
+    @weights.setter
+    def weights(self, weights: np.ndarray):
+        self._weights = weights
+        # float64 weights passed to the numba kernel, rebuilt whenever the weights are reassigned
+        self._numba_weights = np.asarray(weights, dtype=np.float64)
+
     def __act(self, obs: np.array):
         # epsilon-greedy
         coin = np.random.rand()
@@ -98,12 +224,22 @@ class MOQLearning(MOPolicy, MOAgent):
         else:
             return self.eval(obs)
 
+    def _clone_q_table(self) -> COWQTable:
+        """Returns a copy-on-write copy of the Q table."""
+        return self.q_table.clone()
+
+    def _scalarize(self, q_values: np.ndarray, w: np.ndarray) -> np.ndarray:
+        """Scalarizes the Q-values of all actions, with a single matrix-vector product for the weighted sum."""
+        if self._linear_scalarization:
+            return q_values @ w
+        return np.array([self.scalarization(state_action_value, w) for state_action_value in q_values])
+
     def scalarized_q_values(self, obs, w: np.ndarray) -> np.ndarray:
         """Returns the scalarized Q values for each action, given observation and weights."""
         t_obs = tuple(obs)
         if t_obs not in self.q_table:
             return np.zeros(self.action_dim)
-        return np.array([self.scalarization(state_action_value, w) for state_action_value in self.q_table[t_obs]])
+        return self._scalarize(self.q_table[t_obs], w)
 
     @override
     def eval(self, obs: np.array, w: Optional[np.ndarray] = None) -> int:
@@ -111,10 +247,24 @@ class MOQLearning(MOPolicy, MOAgent):
         t_obs = tuple(obs)
         if t_obs not in self.q_table:
             return int(self.env.action_space.sample())
-        scalarized = np.array(
-            [self.scalarization(state_action_value, self.weights) for state_action_value in self.q_table[t_obs]]
+        return int(np.argmax(self._scalarize(self.q_table[t_obs], self.weights)))
+
+    def _numba_update(
+        self, obs: tuple, action: int, reward: np.ndarray, next_obs: tuple, terminated: bool, td_error: np.ndarray
+    ) -> np.ndarray:
+        """Updates the Q-values of (obs, action) with the numba kernel. Writes the TD error into td_error and returns it."""
+        q_values = self.q_table.writable(obs)
+        return _numba_q_step(
+            q_values,
+            self.q_table[next_obs],
+            action,
+            reward,
+            float(terminated),
+            self._numba_weights,
+            self.learning_rate,
+            self.gamma,
+            td_error,
         )
-        return int(np.argmax(scalarized))
 
     @override
     def update(self):
@@ -126,9 +276,12 @@ class MOQLearning(MOPolicy, MOAgent):
         if next_obs not in self.q_table:
             self.q_table[next_obs] = np.zeros((self.action_dim, self.reward_dim))
 
-        max_q = self.q_table[next_obs][self.eval(self.next_obs)]
-        td_error = self.reward + (1 - self.terminated) * self.gamma * max_q - self.q_table[obs][self.action]
-        self.q_table[obs][self.action] += self.learning_rate * td_error
+        if self.use_numba:
+            td_error = self._numba_update(obs, self.action, self.reward, next_obs, self.terminated, self._td_error)
+        else:
+            max_q = self.q_table[next_obs][self.eval(self.next_obs)]
+            td_error = self.reward + (1 - self.terminated) * self.gamma * max_q - self.q_table[obs][self.action]
+            self.q_table.writable(obs)[self.action] += self.learning_rate * td_error
 
         # Dyna updates
         if self.dyna:
@@ -139,9 +292,12 @@ class MOQLearning(MOPolicy, MOAgent):
                     self.q_table[s] = np.zeros((self.action_dim, self.reward_dim))
                 if next_s not in self.q_table:
                     self.q_table[next_s] = np.zeros((self.action_dim, self.reward_dim))
-                max_q = self.q_table[next_s][self.eval(next_s)]
-                model_td = r + (1 - terminal) * self.gamma * max_q - self.q_table[s][a]
-                self.q_table[s][a] += self.learning_rate * model_td
+                if self.use_numba:
+                    self._numba_update(s, a, r, next_s, terminal, self._dyna_td_error)
+                else:
+                    max_q = self.q_table[next_s][self.eval(next_s)]
+                    model_td = r + (1 - terminal) * self.gamma * max_q - self.q_table[s][a]
+                    self.q_table.writable(s)[a] += self.learning_rate * model_td
 
         if self.epsilon_decay_steps is not None:
             self.epsilon = linearly_decaying_value(
@@ -172,6 +328,7 @@ class MOQLearning(MOPolicy, MOAgent):
             "epsilon_decay_steps": self.epsilon_decay_steps,
             "dyna": self.dyna,
             "dyna_updates": self.dyna_updates,
+            "use_numba": self.use_numba,
             "weight": self.weights,
             "scalarization": self.scalarization.__name__,
         }
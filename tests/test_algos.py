@@ -1,18 +1,22 @@
 """Mostly tests to make sure the algorithms are able to run."""
+import random
 import time
 
 import mo_gymnasium as mo_gym
 import numpy as np
+import pytest
 from mo_gymnasium.envs.deep_sea_treasure.deep_sea_treasure import CONCAVE_MAP
 
 from morl_baselines.common.evaluation import eval_mo, eval_mo_reward_conditioned
 from morl_baselines.common.scalarization import tchebicheff
+from morl_baselines.common.utils import equally_spaced_weights
 from morl_baselines.multi_policy.envelope.envelope import Envelope
 from morl_baselines.multi_policy.gpi_pd.gpi_pd import GPIPD
 from morl_baselines.multi_policy.gpi_pd.gpi_pd_continuous_action import (
     GPIPDContinuousAction,
 )
 from morl_baselines.multi_policy.linear_support.linear_support import LinearSupport
+from morl_baselines.multi_policy.multi_policy_moqlearning import mp_mo_q_learning
 from morl_baselines.multi_policy.multi_policy_moqlearning.mp_mo_q_learning import (
     MPMOQLearning,
 )
@@ -21,7 +25,7 @@ from morl_baselines.multi_policy.pcn.pcn import PCN
 from morl_baselines.multi_policy.pgmorl.pgmorl import PGMORL
 from morl_baselines.single_policy.esr.eupg import EUPG
 from morl_baselines.single_policy.ser.mo_ppo import make_env
-from morl_baselines.single_policy.ser.mo_q_learning import MOQLearning
+from morl_baselines.single_policy.ser.mo_q_learning import COWQTable, MOQLearning
 
 
 def test_pql():
@@ -91,6 +95,51 @@ def test_moql():
     assert len(vec_disc_ret) == 2
 
 
+def test_moql_numba_update():
+    env_id = "deep-sea-treasure-v0"
+    weights = np.array([0.3, 0.7])
+
+    for dyna in [False, True]:
+        q_tables = []
+        for use_numba in [False, True]:
+            np.random.seed(42)
+            random.seed(42)
+            env = mo_gym.make(env_id, dst_map=CONCAVE_MAP)
+            env.action_space.seed(42)
+            agent = MOQLearning(env, dyna=dyna, use_numba=use_numba, log=False)
+            # Both update paths must follow reassigned weights
+            agent.weights = weights
+            agent.train(total_timesteps=1000, start_time=time.time())
+            q_tables.append(agent.q_table)
+
+        numpy_q_table, numba_q_table = q_tables
+        assert numpy_q_table.keys() == numba_q_table.keys()
+        for obs in numpy_q_table:
+            assert np.allclose(numpy_q_table[obs], numba_q_table[obs])
+
+    with pytest.raises(AssertionError):
+        MPMOQLearning(mo_gym.make(env_id), scalarization=tchebicheff(tau=4.0, reward_dim=2), use_numba=True, log=False)
+
+
+def test_cow_q_table_clone():
+    q_table = COWQTable()
+    q_table[(0, 0)] = np.zeros((4, 2))
+    clone = q_table.clone()
+
+    # Shared Q-values cannot be updated in place
+    with pytest.raises(ValueError):
+        clone[(0, 0)][0] += 1.0
+
+    clone.writable((0, 0))[0] += 1.0
+    assert np.all(q_table[(0, 0)] == 0.0)
+    assert np.all(clone[(0, 0)][0] == 1.0)
+
+    q_table.writable((0, 0))[1] += 2.0
+    assert np.all(clone[(0, 0)][1] == 0.0)
+    assert np.all(q_table[(0, 0)][1] == 2.0)
+    assert np.all(q_table[(0, 0)][0] == 0.0)
+
+
 def test_mp_moql():
     env_id = "deep-sea-treasure-v0"
     env = mo_gym.make(env_id, dst_map=CONCAVE_MAP)
@@ -110,6 +159,76 @@ def test_mp_moql():
     assert len(front) > 0
 
 
+def test_mp_moql_gpi_action():
+    env_id = "deep-sea-treasure-v0"
+    env = mo_gym.make(env_id, dst_map=CONCAVE_MAP)
+
+    agent = MPMOQLearning(env, use_gpi_policy=True, log=False)
+    policies = []
+    for w in [np.array([1.0, 0.0]), np.array([0.5, 0.5]), np.array([0.0, 1.0])]:
+        policy = MOQLearning(env, weights=w, initial_epsilon=0.9, log=False)
+        policy.train(total_timesteps=1000, start_time=time.time())
+        policies.append(policy)
+    agent.policies = policies
+
+    states = set().union(*(policy.q_table.keys() for policy in agent.policies))
+    for w in equally_spaced_weights(2, n=10):
+        for state in states:
+            q_vals = np.stack([policy.scalarized_q_values(state, w) for policy in agent.policies])
+            _, action = np.unravel_index(np.argmax(q_vals), q_vals.shape)
+            assert agent._gpi_action(np.array(state), w) == action
+
+
+def test_mp_moql_pooled_gpi_front():
+    env_id = "deep-sea-treasure-v0"
+    env = mo_gym.make(env_id, dst_map=CONCAVE_MAP)
+    eval_env = mo_gym.make(env_id, dst_map=CONCAVE_MAP)
+
+    agent = MPMOQLearning(
+        env,
+        initial_epsilon=0.9,
+        epsilon_decay_steps=int(1e3),
+        use_gpi_policy=True,
+        log=False,
+    )
+    agent.train(eval_env=eval_env, ref_point=np.array([0.0, -25.0]), num_iterations=2, timesteps_per_iteration=1000)
+
+    weights = np.array(equally_spaced_weights(2, n=10))
+    sequential_front = agent._evaluate_gpi_front(eval_env, weights, rep=1)
+    agent.num_eval_workers = 2
+    pooled_front = agent._evaluate_gpi_front(eval_env, weights, rep=1)
+    agent._close_eval_pool()
+    assert np.allclose(pooled_front, sequential_front)
+
+
+def test_mp_moql_background_logging(monkeypatch):
+    monkeypatch.setenv("WANDB_MODE", "disabled")
+    env_id = "deep-sea-treasure-v0"
+    env = mo_gym.make(env_id, dst_map=CONCAVE_MAP)
+    eval_env = mo_gym.make(env_id, dst_map=CONCAVE_MAP)
+
+    logged_steps = []
+
+    def log_metrics(global_step, **kwargs):
+        logged_steps.append(global_step)
+
+    monkeypatch.setattr(mp_mo_q_learning, "log_all_multi_policy_metrics", log_metrics)
+    agent = MPMOQLearning(env, log=True)
+    # Each call to train closes wandb at the end, so the logging thread must be restarted by the next one
+    for _ in range(2):
+        agent.train(eval_env=eval_env, ref_point=np.array([0.0, -25.0]), num_iterations=2, timesteps_per_iteration=100)
+    assert logged_steps == [100, 200, 300, 400]
+
+    def failing_log_metrics(**kwargs):
+        raise ValueError("Logging failed.")
+
+    monkeypatch.setattr(mp_mo_q_learning, "log_all_multi_policy_metrics", failing_log_metrics)
+    agent = MPMOQLearning(env, log=True)
+    with pytest.raises(ValueError, match="Logging failed."):
+        agent.train(eval_env=eval_env, ref_point=np.array([0.0, -25.0]), num_iterations=2, timesteps_per_iteration=100)
+    agent.close_wandb()
+
+
 def test_ols():
     env = mo_gym.make("deep-sea-treasure-v0")
 
@@ -139,6 +258,31 @@ def test_ols():
             policies.pop(ind)  # remove policies that are no longer needed
 
 
+def test_linear_support_add_solution():
+    ls = LinearSupport(num_objectives=2, verbose=False)
+    assert ls.add_solution(np.array([1.0, 0.0]), np.array([1.0, 0.0])) == []
+    assert ls.add_solution(np.array([0.0, 1.0]), np.array([0.0, 1.0])) == []
+
+    # Ties with the CCS for a visited weight: neither dominated nor removing other values
+    assert ls.add_solution(np.array([0.5, 0.5]), np.array([0.5, 0.5])) == []
+    assert np.all(ls.ccs == np.array([[1.0, 0.0], [0.0, 1.0], [0.5, 0.5]]))
+
+    # Strictly worse than the CCS for all visited weights: discarded
+    assert ls.add_solution(np.array([0.4, 0.4]), np.array([0.5, 0.5])) == [3]
+    assert len(ls.ccs) == 3
+    assert len(ls.weight_support) == 3
+
+    # Equal to a value of the CCS: the old value is replaced
+    assert ls.add_solution(np.array([1.0, 0.0]), np.array([1.0, 0.0])) == [0]
+    assert np.all(ls.ccs == np.array([[0.0, 1.0], [0.5, 0.5], [1.0, 0.0]]))
+    assert np.all(np.array(ls.weight_support) == np.array([[0.0, 1.0], [0.5, 0.5], [1.0, 0.0]]))
+
+    # At least as good as all values for all visited weights: the whole CCS is removed
+    assert ls.add_solution(np.array([2.0, 2.0]), np.array([0.5, 0.5])) == [2, 1, 0]
+    assert np.all(ls.ccs == np.array([[2.0, 2.0]]))
+    assert np.all(np.array(ls.weight_support) == np.array([[0.5, 0.5]]))
+
+
 def test_envelope():
     env = mo_gym.make("minecart-v0")
     eval_env = mo_gym.make("minecart-v0")